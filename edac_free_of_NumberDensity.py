@@ -26,6 +26,8 @@ from pysph.sph.integrator_step import IntegratorStep
 
 from pysph.sph.scheme import Scheme, add_bool_argument
 
+from transport_velocity_free_of_NumberDensity import ensure_soa_properties
+
 
 EDAC_PROPS = ('ap', 'au', 'av', 'aw', 'ax', 'ay', 'az',
               'x0', 'y0', 'z0', 'u0', 'v0', 'w0', 'p0', 'V')
@@ -40,6 +42,10 @@ def get_particle_array_edac(constants=None, **props):
 
 EDAC_SOLID_PROPS = ('ap', 'p0', 'wij', 'uf', 'vf', 'wf', 'ug', 'vg', 'wg', 'ax', 'ay', 'az', 'V')
 
+# Properties read by the pair kernels, these must be contiguous doubles.
+SOA_FLUID_PROPS = ('x', 'y', 'z', 'h', 'm', 'rho', 'p', 'V', 'u', 'v', 'w')
+SOA_SOLID_PROPS = SOA_FLUID_PROPS + ('ug', 'vg', 'wg')
+
 def get_particle_array_edac_solid(constants=None, **props):
     "Get the fluid array for the transport velocity formulation"
 
@@ -140,6 +146,7 @@ class SolidWallPressureBC(Equation):
 
     def loop(self, d_idx, s_idx, d_p, s_p, s_rho,
              d_au, d_av, d_aw, WIJ, XIJ):
+        gdotxij = declare('double')
 
         # numerator of Eq. (27) ax, ay and az are the prescribed wall
         # accelerations which must be defined for the wall boundary
@@ -148,7 +155,7 @@ class SolidWallPressureBC(Equation):
             (self.gy - d_av[d_idx])*XIJ[1] + \
             (self.gz - d_aw[d_idx])*XIJ[2]
 
-        d_p[d_idx] += s_p[s_idx]*WIJ + s_rho[s_idx]*gdotxij*WIJ
+        d_p[d_idx] += (s_p[s_idx] + s_rho[s_idx]*gdotxij)*WIJ
 
     def post_loop(self, d_idx, d_wij, d_p):
         # extrapolated pressure at the ghost particle
@@ -223,6 +230,67 @@ class SetWallVelocity(Equation):
         d_wg[d_idx] = 2*d_w[d_idx] - d_wf[d_idx]
 
 
+class SolidWallBC(Equation):
+    r"""Wall pressure and ghost velocity of a no-slip solid in one pass.
+
+    This does the work of `SourceNumberDensity`, `SolidWallPressureBC` and
+    `SetWallVelocity` for the same destination and sources.  The Shepard sum
+    :math:`\sum_b W_{ab}` is accumulated with the pressure and the filtered
+    velocity in one neighbor loop, and its reciprocal is taken once to
+    normalize both.
+
+    The destination particle array should define `wij`, the *filtered*
+    velocity `uf, vf, wf` and the ghost velocity `ug, vg, wg`.
+
+    """
+    def __init__(self, dest, sources, gx=0.0, gy=0.0, gz=0.0):
+        self.gx = gx
+        self.gy = gy
+        self.gz = gz
+
+        super(SolidWallBC, self).__init__(dest, sources)
+
+    def initialize(self, d_idx, d_wij, d_p, d_uf, d_vf, d_wf):
+        d_wij[d_idx] = 0.0
+        d_p[d_idx] = 0.0
+        d_uf[d_idx] = 0.0
+        d_vf[d_idx] = 0.0
+        d_wf[d_idx] = 0.0
+
+    def loop(self, d_idx, s_idx, d_wij, d_p, d_uf, d_vf, d_wf,
+             d_au, d_av, d_aw, s_p, s_rho, s_u, s_v, s_w, WIJ, XIJ):
+        gdotxij = declare('double')
+        d_wij[d_idx] += WIJ
+
+        # numerator of Eq. (27), see SolidWallPressureBC
+        gdotxij = (self.gx - d_au[d_idx])*XIJ[0] + \
+            (self.gy - d_av[d_idx])*XIJ[1] + \
+            (self.gz - d_aw[d_idx])*XIJ[2]
+        d_p[d_idx] += (s_p[s_idx] + s_rho[s_idx]*gdotxij)*WIJ
+
+        # sum in Eq. (22), see SetWallVelocity
+        d_uf[d_idx] += s_u[s_idx] * WIJ
+        d_vf[d_idx] += s_v[s_idx] * WIJ
+        d_wf[d_idx] += s_w[s_idx] * WIJ
+
+    def post_loop(self, d_idx, d_wij, d_p, d_uf, d_vf, d_wf,
+                  d_ug, d_vg, d_wg, d_u, d_v, d_w):
+        wij, wij1 = declare('double', 2)
+        wij = d_wij[d_idx]
+        if wij > 1e-14:
+            wij1 = 1.0/wij
+            d_p[d_idx] *= wij1
+            if wij > 1e-12:
+                d_uf[d_idx] *= wij1
+                d_vf[d_idx] *= wij1
+                d_wf[d_idx] *= wij1
+
+        # Dummy velocities at the ghost points using Eq. (23)
+        d_ug[d_idx] = 2*d_u[d_idx] - d_uf[d_idx]
+        d_vg[d_idx] = 2*d_v[d_idx] - d_vf[d_idx]
+        d_wg[d_idx] = 2*d_w[d_idx] - d_wf[d_idx]
+
+
 class NoSlipVelocityExtrapolation(Equation):
     '''No Slip boundary condition on the wall
 
@@ -242,6 +310,7 @@ class NoSlipVelocityExtrapolation(Equation):
         d_w[d_idx] += s_w[s_idx]*WIJ
 
     def post_loop(self, d_idx, d_wij, d_u, d_v, d_w, d_xn, d_yn, d_zn):
+        projection = declare('double')
         if d_wij[d_idx] > 1e-14:
             d_u[d_idx] /= d_wij[d_idx]
             d_v[d_idx] /= d_wij[d_idx]
@@ -275,6 +344,7 @@ class NoSlipAdvVelocityExtrapolation(Equation):
 
     def post_loop(self, d_idx, d_wij, d_uhat, d_vhat, d_what, d_xn, d_yn,
                   d_zn):
+        projection = declare('double')
         if d_wij[d_idx] > 1e-14:
             d_uhat[d_idx] /= d_wij[d_idx]
             d_vhat[d_idx] /= d_wij[d_idx]
@@ -309,7 +379,7 @@ class MomentumEquation(Equation):
 
     def loop(self, d_idx, s_idx, d_m, d_rho, d_p, d_V, d_au, d_av, d_aw,
              s_m, s_rho, s_p, s_V, DWIJ):
-
+        rhoi2, rhoj2, pij, tmp = declare('double', 4)
 
         rhoi2 = d_rho[d_idx] * d_rho[d_idx]
         rhoj2 = s_rho[s_idx] * s_rho[s_idx]
@@ -324,12 +394,15 @@ class MomentumEquation(Equation):
         d_aw[d_idx] += tmp * DWIJ[2]
 
     def post_loop(self, d_idx, d_au, d_av, d_aw, t):
+        damping_factor = declare('double')
+        # damped accelerations due to body or external force
         damping_factor = 1.0
         if t < self.tdamp:
             damping_factor = 0.5 * (sin((-0.5 + t/self.tdamp)*M_PI) + 1.0)
-        d_au[d_idx] += damping_factor*self.gx
-        d_av[d_idx] += damping_factor*self.gy
-        d_aw[d_idx] += damping_factor*self.gz
+
+        d_au[d_idx] += self.gx * damping_factor
+        d_av[d_idx] += self.gy * damping_factor
+        d_aw[d_idx] += self.gz * damping_factor
 
 
 class EDACEquation(Equation):
@@ -337,31 +410,31 @@ class EDACEquation(Equation):
         self.cs = cs
         self.nu = nu
         self.rho0 = rho0
+        self.cs2 = cs*cs
+        self.nu2 = 2.0*nu
 
         super(EDACEquation, self).__init__(dest, sources)
 
     def initialize(self, d_idx, d_ap):
         d_ap[d_idx] = 0.0
 
-    def loop(self, d_idx, d_m, d_rho, d_ap, d_p, d_V, s_idx, s_m, s_rho, s_p,
-             s_V, DWIJ, VIJ, XIJ, R2IJ, EPS):
-
-
-        etai = d_rho[d_idx]
-        etaj = s_rho[s_idx]
-        etaij = 2 * self.nu * (etai * etaj)/(etai + etaj)
-
-        # This is the same as continuity acceleration times cs^2
+    def loop(self, d_idx, d_rho, d_ap, d_p, s_idx, s_m, s_rho, s_p,
+             DWIJ, VIJ, XIJ, R2IJ, EPS):
+        rhoi, rhoj, vijdotdwij, xdotdwij, fac = declare('double', 5)
         rhoi = d_rho[d_idx]
         rhoj = s_rho[s_idx]
-        vijdotdwij = DWIJ[0]*VIJ[0] + DWIJ[1]*VIJ[1] + DWIJ[2]*VIJ[2]
-        d_ap[d_idx] += rhoi/rhoj*self.cs*self.cs*s_m[s_idx]*vijdotdwij
 
-        # Viscous damping of pressure.
+        # This is the same as continuity acceleration times cs^2
+        vijdotdwij = DWIJ[0]*VIJ[0] + DWIJ[1]*VIJ[1] + DWIJ[2]*VIJ[2]
+        d_ap[d_idx] += self.cs2*rhoi*s_m[s_idx]*vijdotdwij/rhoj
 
+        # Viscous damping of pressure.  With eta = rho, the harmonic mean
+        # 2 nu eta_i eta_j/(eta_i + eta_j) times m_j/(rho_i rho_j) is
+        # 2 nu m_j/(rho_i + rho_j).
         xdotdwij = DWIJ[0]*XIJ[0] + DWIJ[1]*XIJ[1] + DWIJ[2]*XIJ[2]
-        tmp = s_m[s_idx]/(d_rho[d_idx] * s_rho[s_idx])
-        fac = tmp * etaij * xdotdwij/(R2IJ + EPS)
+        fac = self.nu2 * s_m[s_idx] * xdotdwij/(
+            (rhoi + rhoj) * (R2IJ + EPS)
+        )
         d_ap[d_idx] += fac * (d_p[d_idx] - s_p[s_idx])
 
 class MomentumEquationPressureGradient(Equation):
@@ -420,9 +493,11 @@ class MomentumEquationPressureGradient(Equation):
 
         d_pb0[d_idx] = min(10*abs(d_p[d_idx]), self.pb)
 
-    def loop(self, d_idx, s_idx, d_m, d_rho, s_rho, s_m,
-             d_au, d_av, d_aw, d_p, d_pavg, d_pb0, XIJ, RIJ, SPH_KERNEL, HIJ, s_p,
-             d_auhat, d_avhat, d_awhat, DWIJ):
+    def loop(self, d_idx, s_idx, d_rho, s_rho, s_m, d_au, d_av, d_aw, d_p,
+             d_pb0, XIJ, RIJ, SPH_KERNEL, HIJ, s_p, d_auhat, d_avhat,
+             d_awhat, DWIJ):
+        rhoi2, rhoj2, pij, tmp = declare('double', 4)
+        dwijhat = declare('matrix(3)')
 
         # averaged pressure Eq. (7)
         rhoi2 = d_rho[d_idx] * d_rho[d_idx]
@@ -437,8 +512,7 @@ class MomentumEquationPressureGradient(Equation):
         d_aw[d_idx] += tmp * DWIJ[2]
 
         tmp = -d_pb0[d_idx] * s_m[s_idx]/rhoi2
-        
-        dwijhat = declare('matrix(3)')
+
         SPH_KERNEL.gradient(XIJ, RIJ, 0.5*HIJ, dwijhat)
 
         d_auhat[d_idx] += tmp * dwijhat[0]
@@ -446,6 +520,7 @@ class MomentumEquationPressureGradient(Equation):
         d_awhat[d_idx] += tmp * dwijhat[2]
 
     def post_loop(self, d_idx, d_au, d_av, d_aw, t):
+        damping_factor = declare('double')
         # damped accelerations due to body or external force
         damping_factor = 1.0
         if t < self.tdamp:
@@ -711,6 +786,7 @@ class EDACScheme(Scheme):
         for fluid in fluids_with_io:
             pa = particle_arrays[fluid]
             self._ensure_properties(pa, all_fluid_props, clean)
+            ensure_soa_properties(pa, SOA_FLUID_PROPS)
             pa.set_output_arrays(['x', 'y', 'z', 'u', 'v', 'w', 'rho', 'p',
                                   'm', 'h', 'V'])
             if 'pavg' in pa.properties:
@@ -728,6 +804,7 @@ class EDACScheme(Scheme):
         for solid in (self.solids+self.inviscid_solids):
             pa = particle_arrays[solid]
             self._ensure_properties(pa, all_solid_props, clean)
+            ensure_soa_properties(pa, SOA_SOLID_PROPS)
             pa.set_output_arrays(['x', 'y', 'z', 'u', 'v', 'w', 'rho', 'p',
                                   'm', 'h', 'V'])
 
@@ -777,12 +854,10 @@ class EDACScheme(Scheme):
                     group1.append(eq)
 
         for solid in self.solids:
-            group1.extend([
-                SourceNumberDensity(dest=solid, sources=fluids_with_io),
-                SolidWallPressureBC(dest=solid, sources=fluids_with_io,
-                                    gx=self.gx, gy=self.gy, gz=self.gz),
-                SetWallVelocity(dest=solid, sources=fluids_with_io),
-            ])
+            group1.append(
+                SolidWallBC(dest=solid, sources=fluids_with_io,
+                            gx=self.gx, gy=self.gy, gz=self.gz)
+            )
         for solid in self.inviscid_solids:
             group1.extend([
                 SourceNumberDensity(dest=solid, sources=fluids_with_io),
@@ -859,12 +934,10 @@ class EDACScheme(Scheme):
         for fluid in self.fluids:
             group1.append(SummationDensity(dest=fluid, sources=all))
         for solid in self.solids:
-            group1.extend([
-                SourceNumberDensity(dest=solid, sources=self.fluids),
-                SolidWallPressureBC(dest=solid, sources=self.fluids,
-                                    gx=self.gx, gy=self.gy, gz=self.gz),
-                SetWallVelocity(dest=solid, sources=self.fluids),
-            ])
+            group1.append(
+                SolidWallBC(dest=solid, sources=self.fluids,
+                            gx=self.gx, gy=self.gy, gz=self.gz)
+            )
             if self.clamp_p:
                 group1.append(
                     ClampWallPressure(dest=solid, sources=None)
@@ -1,17 +1,34 @@
 # flow past cylinder
-import numpy as np
+import hashlib
 import os
-
-from pysph.base.kernels import QuinticSpline
-from pysph.sph.equation import Equation
-from pysph.base.utils import get_particle_array
-from pysph.solver.application import Application
-from pysph.sph.scheme import SchemeChooser
-from edac_free_of_NumberDensity import EDACScheme, SourceNumberDensity
-from pysph.tools import geometry as G
-from edac_free_of_NumberDensity import SolidWallPressureBC
-from pysph.sph.bc.simple_inlet_outlet import SimpleInletOutlet
-from pysph.sph.bc.inlet_outlet_manager import (
+import tempfile
+
+# The OpenMP runtime reads OMP_NUM_THREADS when the first compiled module is
+# loaded, so it has to be set before numpy and pysph are imported, which is
+# also why the imports below are not at the top.  The pair loops stop scaling
+# beyond a few threads and oversubscribing the cores slows them down, so the
+# thread count is capped unless set by the user.  Note that this is done on
+# import, so it also applies to any process that imports this module.
+os.environ.setdefault('OMP_NUM_THREADS', str(min(8, os.cpu_count() or 1)))
+
+import numpy as np  # noqa: E402
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+from pysph.base.kernels import WendlandQuintic  # noqa: E402
+from pysph.sph.equation import Equation  # noqa: E402
+from pysph.base.utils import get_particle_array  # noqa: E402
+from pysph.solver.application import Application  # noqa: E402
+from pysph.sph.scheme import SchemeChooser, add_bool_argument  # noqa: E402
+from edac_free_of_NumberDensity import (  # noqa: E402
+    EDACScheme, SourceNumberDensity, SolidWallPressureBC
+)
+from pysph.tools import geometry as G  # noqa: E402
+from pysph.sph.bc.simple_inlet_outlet import SimpleInletOutlet  # noqa: E402
+from pysph.sph.bc.inlet_outlet_manager import (  # noqa: E402
         InletInfo, OutletInfo)
 
 # Geometric parameters
@@ -29,20 +46,38 @@ umax = 1.0
 c0 = 10 * umax
 p0 = rho * c0 * c0
 
+# Order of the arrays returned by create_particles.
+PARTICLE_NAMES = ('fluid', 'inlet', 'outlet', 'solid', 'wall')
+
+# Properties needed on the solid and fluid to evaluate the forces.
+FORCE_PROPS = ['awhat', 'auhat', 'avhat', 'wg', 'vg', 'ug', 'uf', 'vf',
+               'wf', 'wij', 'vmag']
+
+
+def make_grid(xs, ys):
+    """Flat coordinates of the lattice `xs` x `ys` with x varying slowest.
+
+    Only the two output arrays are allocated, no intermediate 2D grids.
+    """
+    return np.repeat(xs, ys.size), np.tile(ys, xs.size)
+
 
 class ExtrapolateUhat(Equation):
+    """Shepard extrapolation of the fluid advection velocity to the inlet.
+
+    `d_wij` is also used by the pressure BC on the inlet.
+    """
     def initialize(self, d_idx, d_uhat, d_wij):
         d_uhat[d_idx] = 0.0
         d_wij[d_idx] = 0.0
 
-    def loop(self, d_idx, s_idx, d_uhat, s_uhat, d_wij, s_rho,
-             d_au, d_av, d_aw, WIJ, XIJ):
+    def loop(self, d_idx, s_idx, d_uhat, s_uhat, d_wij, WIJ):
         d_uhat[d_idx] += s_uhat[s_idx]*WIJ
         d_wij[d_idx] += WIJ
 
-    def post_loop(self, d_idx, d_wij, d_uhat, d_rho):
+    def post_loop(self, d_idx, d_wij, d_uhat):
         if d_wij[d_idx] > 1e-14:
-            d_uhat[d_idx] /= d_wij[d_idx]
+            d_uhat[d_idx] *= 1.0/d_wij[d_idx]
 
 
 class ResetInletVelocity(Equation):
@@ -53,15 +88,17 @@ class ResetInletVelocity(Equation):
 
         super(ResetInletVelocity, self).__init__(dest, sources)
 
-    def loop(self, d_idx, d_u, d_v, d_w, d_x, d_y, d_z, d_xn, d_yn, d_zn):
+    def initialize(self, d_idx, d_u, d_v, d_w):
         d_u[d_idx] = self.U
         d_v[d_idx] = self.V
         d_w[d_idx] = self.W
 
 
 class WindTunnel(Application):
-    def pre_step(self, solver):
-        solver.dump_output()
+    def initialize(self):
+        # Every group walks the same fluid and solid neighbors, so by default
+        # the neighbor lists are built once per step and reused by each group.
+        self.cache_nnps = True
 
     def add_user_options(self, group):
         group.add_argument(
@@ -76,18 +113,45 @@ class WindTunnel(Application):
             "--nx", action="store", type=int, dest="nx", default=20,
             help="Number of points in 1D of the cylinder. (default 20)"
         )
+        # PySPH's --reorder-freq is resolved in consume_user_options as the
+        # default depends on the NNPS and backend.
+        group.set_defaults(reorder_freq=None)
+        group.add_argument(
+            "--no-cache-nnps", action="store_false", dest="cache_nnps",
+            help="Do not cache the neighbor lists across the groups."
+        )
+        add_bool_argument(
+            group, 'particle-cache', dest='particle_cache',
+            help="Reuse the initial particles cached by an earlier run with "
+            "the same geometry, --nx and --hdx.", default=False
+        )
 
     def consume_user_options(self):
         nx = self.options.nx
         re = self.options.re
 
+        # Use OpenMP unless it was turned off explicitly. The equations are
+        # also generated for PySPH's OpenCL and CUDA backends, in which case
+        # the device runs them and OpenMP is not used.
+        on_gpu = self.options.with_opencl or self.options.with_cuda
+        if self.options.with_openmp is None and not on_gpu:
+            self.options.with_openmp = True
+
+        # Spatially reordering the particles keeps neighbors close in memory.
+        # Turn it on for the default linked list NNPS on the CPU, elsewhere
+        # PySPH's own defaults apply.
+        if (self.options.reorder_freq is None and
+                self.options.nnps == 'll' and not on_gpu):
+            self.options.reorder_freq = 100
+
         self.nu = nu = umax * diameter / re
 
         self.dx = dx = diameter / nx
         self.volume = dx * dx
+        self.m = self.volume * rho
         self.hdx = self.options.hdx
+        self.h0 = h0 = self.hdx * self.dx
 
-        h0 = self.hdx * self.dx
         dt_cfl = 0.25 * h0 / (c0 + umax)
         dt_viscous = 0.125 * h0**2 / nu
 
@@ -96,38 +160,24 @@ class WindTunnel(Application):
 
     def _create_fluid(self):
         dx = self.dx
-        h0 = self.hdx * self.dx
-        x, y = np.mgrid[dx / 2:l_tunnel:dx, -w_tunnel + dx/2:w_tunnel:dx]
-        x, y = (np.ravel(t) for t in (x, y))
-        one = np.ones_like(x)
-        volume = dx * dx * one
-        m = volume * rho
+        xs = np.arange(dx / 2, l_tunnel, dx)
+        ys = np.arange(-w_tunnel + dx/2, w_tunnel, dx)
+        x, y = make_grid(xs, ys)
         fluid = get_particle_array(
-            name='fluid', m=m, x=x, y=y, h=h0, u=umax, p=0.0,
+            name='fluid', m=self.m, x=x, y=y, h=self.h0, u=umax, p=0.0,
             rho=rho
         )
         return fluid
 
     def _create_wall(self):
         dx = self.dx
-        h0 = self.hdx * self.dx
-        x0, y0 = np.mgrid[
-            dx/2: l_tunnel+n_inlet*dx+n_outlet*dx: dx, dx/2: n_wall*dx: dx]
-        x0 -= n_inlet*dx
-        y0 -= n_wall*dx+w_tunnel
-        x0 = np.ravel(x0)
-        y0 = np.ravel(y0)
-
-        x1 = np.copy(x0)
-        y1 = np.copy(y0)
-        y1 += n_wall*dx+2*w_tunnel
-        x1 = np.ravel(x1)
-        y1 = np.ravel(y1)
-        x0 = np.concatenate((x0, x1))
-        y0 = np.concatenate((y0, y1))
-        volume = dx*dx
+        xs = np.arange(dx/2, l_tunnel+n_inlet*dx+n_outlet*dx, dx) - n_inlet*dx
+        ys_bot = np.arange(dx/2, n_wall*dx, dx) - n_wall*dx - w_tunnel
+        ys_top = ys_bot + n_wall*dx + 2*w_tunnel
+        ys = np.concatenate((ys_bot, ys_top))
+        x, y = make_grid(xs, ys)
         wall = get_particle_array(
-            name='wall', x=x0, y=y0, m=volume*rho, rho=rho, h=h0)
+            name='wall', x=x, y=y, m=self.m, rho=rho, h=self.h0)
         return wall
 
     def _set_wall_normal(self, pa):
@@ -135,67 +185,133 @@ class WindTunnel(Application):
         for p in props:
             pa.add_property(p)
 
-        y = pa.y
-        cond = y > 0.0
-        pa.yn[cond] = 1.0
-        cond = y < 0.0
-        pa.yn[cond] = -1.0
+        # The walls never lie on y = 0 so the sign is always +/-1.
+        np.copyto(pa.yn, np.sign(pa.y))
 
     def _create_solid(self):
         dx = self.dx
-        h0 = self.hdx * self.dx
-        x, y = np.mgrid[dx / 2:l_tunnel:dx, -w_tunnel + dx/2:w_tunnel:dx]
-        x, y = (np.ravel(t) for t in (x, y))
+        xs = np.arange(dx / 2, l_tunnel, dx)
+        ys = np.arange(-w_tunnel + dx/2, w_tunnel, dx)
+        x, y = make_grid(xs, ys)
         xc, yc = center
-        cond = (x - xc)**2 + (y - yc)**2 < (diameter/2*diameter/2)
-        volume = dx*dx
+        r2 = (0.5*diameter)**2
+        if ne is not None:
+            cond = ne.evaluate(
+                '(x - xc)**2 + (y - yc)**2 < r2',
+                local_dict=dict(x=x, y=y, xc=xc, yc=yc, r2=r2)
+            )
+        else:
+            dist2 = np.square(x - xc)
+            dist2 += np.square(y - yc)
+            cond = dist2 < r2
+        idx = np.flatnonzero(cond)
         solid = get_particle_array(
-            name='solid', x=x[cond].ravel(), y=y[cond].ravel(), m=volume*rho,
-            rho=rho, h=h0
+            name='solid', x=x[idx], y=y[idx], m=self.m,
+            rho=rho, h=self.h0
         )
         return solid
 
     def _create_outlet(self):
         dx = self.dx
-        h0 = self.hdx * self.dx
-        x, y = np.mgrid[dx/2:n_outlet * dx:dx,  -w_tunnel + dx/2:w_tunnel:dx]
-        x, y = (np.ravel(t) for t in (x, y))
-        x += l_tunnel
-        one = np.ones_like(x)
-        volume = dx * dx * one
-        m = volume * rho
+        xs = np.arange(dx/2, n_outlet * dx, dx) + l_tunnel
+        ys = np.arange(-w_tunnel + dx/2, w_tunnel, dx)
+        x, y = make_grid(xs, ys)
         outlet = get_particle_array(
-            name='outlet', x=x, y=y, m=m, h=h0, u=umax,
-            uhat=umax, p=0.0, rho=one * rho
+            name='outlet', x=x, y=y, m=self.m, h=self.h0, u=umax,
+            uhat=umax, p=0.0, rho=rho
         )
         return outlet
 
     def _create_inlet(self):
         dx = self.dx
-        h0 = self.hdx * self.dx
-        x, y = np.mgrid[dx / 2:n_inlet*dx:dx, -w_tunnel + dx/2:w_tunnel:dx]
-        x, y = (np.ravel(t) for t in (x, y))
-        x = x - n_inlet * dx
-        one = np.ones_like(x)
-        volume = one * dx * dx
+        xs = np.arange(dx / 2, n_inlet*dx, dx) - n_inlet * dx
+        ys = np.arange(-w_tunnel + dx/2, w_tunnel, dx)
+        x, y = make_grid(xs, ys)
 
         inlet = get_particle_array(
-            name='inlet', x=x, y=y, m=volume * rho, h=h0, u=umax, rho=rho, p=0.0
+            name='inlet', x=x, y=y, m=self.m, h=self.h0, u=umax, rho=rho, p=0.0
         )
         return inlet
 
-    def create_particles(self):
-        fluid = self._create_fluid()
-        solid = self._create_solid()
-        outlet = self._create_outlet()
-        inlet = self._create_inlet()
-        wall = self._create_wall()
-        G.remove_overlap_particles(fluid, solid, dx_solid=self.dx, dim=2)
-
-        particles = [
-            fluid, inlet, outlet, solid, wall
+    def _sort_by_cell(self, pa):
+        """Reorder the particles of `pa` in place by a row-major cell index.
+
+        Particles that are close in space become close in memory which makes
+        the neighbor searches walk contiguous chunks of the arrays.
+        """
+        cell = 2.0*self.dx
+        x, y = pa.x, pa.y
+        if len(x) == 0:
+            return
+        cx = np.floor((x - x.min())/cell).astype(np.int32)
+        cy = np.floor((y - y.min())/cell).astype(np.int32)
+        key = cy*(cx.max() + 1) + cx
+        order = np.argsort(key, kind='stable')
+        for prop, arr in pa.properties.items():
+            data = arr.get_npy_array()
+            stride = pa.stride.get(prop, 1)
+            data[:] = data.reshape(-1, stride)[order].ravel()
+
+    def _get_particle_cache(self):
+        # The cache is kept next to the output directory so runs at different
+        # Re share it, the key covers every input of the particle generators.
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(self.output_dir)),
+            'particle_cache'
+        )
+        inputs = (
+            l_tunnel, w_tunnel, diameter, center, n_inlet, n_outlet, n_wall,
+            rho, umax, self.options.nx, self.options.hdx
+        )
+        key = hashlib.sha1(repr(inputs).encode()).hexdigest()
+        return os.path.join(cache_dir, key + '.npz')
+
+    def _load_particles(self, fname):
+        props = {}
+        with np.load(fname) as data:
+            for key in data.files:
+                name, prop = key.split('.', 1)
+                props.setdefault(name, {})[prop] = data[key]
+        return [
+            get_particle_array(name=name, **props[name])
+            for name in PARTICLE_NAMES
         ]
 
+    def _save_particles(self, fname, particles):
+        data = {}
+        for pa in particles:
+            for prop in pa.properties:
+                data['%s.%s' % (pa.name, prop)] = pa.get(prop)
+        # Write to a temporary file and rename it so that concurrent runs
+        # never read a partially written cache.
+        cache_dir = os.path.dirname(fname)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                dir=cache_dir, suffix='.npz', delete=False) as f:
+            np.savez(f, **data)
+        os.replace(f.name, fname)
+
+    def create_particles(self):
+        fname = self._get_particle_cache()
+        if self.options.particle_cache and os.path.exists(fname):
+            particles = self._load_particles(fname)
+        else:
+            fluid = self._create_fluid()
+            solid = self._create_solid()
+            outlet = self._create_outlet()
+            inlet = self._create_inlet()
+            wall = self._create_wall()
+            self._sort_by_cell(fluid)
+            self._sort_by_cell(solid)
+            G.remove_overlap_particles(fluid, solid, dx_solid=self.dx, dim=2)
+
+            particles = [
+                fluid, inlet, outlet, solid, wall
+            ]
+            if self.options.particle_cache:
+                self._save_particles(fname, particles)
+
+        wall = particles[PARTICLE_NAMES.index('wall')]
         self._set_wall_normal(wall)
         self.scheme.setup_properties(particles)
 
@@ -218,16 +334,25 @@ class WindTunnel(Application):
 
     def configure_scheme(self):
         scheme = self.scheme
-        h0 = self.hdx * self.dx
         pfreq = 50
-        kernel = QuinticSpline(dim=2)
+        # The inlet/outlet manager keeps this instance, so it is resolved
+        # from --kernel here rather than left to PySPH to swap later.
+        kernel = self._get_kernel()
         self.iom.update_dx(self.dx)
         if self.options.scheme == 'edac':
-            scheme.configure(h=h0, nu=self.nu, pb=p0)
+            scheme.configure(h=self.h0, nu=self.nu, pb=p0)
 
         scheme.configure_solver(kernel=kernel, tf=self.tf, dt=self.dt,
                                 pfreq=pfreq, n_damp=0)
 
+    def _get_kernel(self):
+        # The Wendland kernel has a support of 2h and so far fewer neighbors
+        # than the quintic spline's 3h, PySPH's --kernel selects another one.
+        from pysph.base import kernels
+        name = self.options.kernel
+        kernel_cls = getattr(kernels, name) if name else WendlandQuintic
+        return kernel_cls(dim=2)
+
     def _create_inlet_outlet_manager(self):
         inleteqns = [
             ResetInletVelocity('inlet', [], U=umax, V=0.0, W=0.0),
@@ -263,11 +388,10 @@ class WindTunnel(Application):
             return
         t, cd, cl = self._plot_force_vs_t()
         res = os.path.join(self.output_dir, 'results.npz')
-        np.savez(res, t=t, cd=cd, cl=cl)
+        np.savez_compressed(res, t=t, cd=cd, cl=cl)
 
     def _get_force_evaluator(self):
         from pysph.solver.utils import load
-        from pysph.base.kernels import QuinticSpline
         from pysph.tools.sph_evaluator import SPHEvaluator
         from pysph.sph.equation import Group
         from transport_velocity_free_of_NumberDensity import (
@@ -278,11 +402,7 @@ class WindTunnel(Application):
         solid = data['arrays']['solid']
         fluid = data['arrays']['fluid']
 
-        prop = ['awhat', 'auhat', 'avhat', 'wg', 'vg', 'ug', 'uf', 'vf',
-                'wf', 'wij', 'vmag']
-        for p in prop:
-            solid.add_property(p)
-            fluid.add_property(p)
+        self._add_force_props(solid, fluid)
         equations = [
             Group(
                 equations=[
@@ -301,33 +421,60 @@ class WindTunnel(Application):
         ]
         sph_eval = SPHEvaluator(
             arrays=[solid, fluid], equations=equations, dim=2,
-            kernel=QuinticSpline(dim=2)
+            kernel=self._get_kernel()
         )
 
-        return sph_eval
+        return sph_eval, solid, fluid
+
+    def _add_force_props(self, *arrays):
+        for pa in arrays:
+            for p in FORCE_PROPS:
+                if p not in pa.properties:
+                    pa.add_property(p)
+
+    def _copy_frame(self, dest, src):
+        for prop in src.properties:
+            getattr(dest, prop)[:] = getattr(src, prop)
 
     def _plot_force_vs_t(self):
-        from pysph.solver.utils import iter_output
-        prop = ['awhat', 'auhat', 'avhat', 'wg', 'vg', 'ug', 'uf', 'vf',
-                'wf', 'wij', 'vmag']
+        from concurrent.futures import ThreadPoolExecutor
+        from pysph.solver.utils import load
         # We find the force of the solid on the fluid and the opposite of that
         # is the force on the solid. Note that the assumption is that the solid
         # is far from the inlet and outlet so those are ignored.
-        sph_eval = self._get_force_evaluator()
-
-        t, cd, cl = [], [], []
-        for sd, arrays in iter_output(self.output_files):
-            fluid = arrays['fluid']
-            solid = arrays['solid']
-            for p in prop:
-                solid.add_property(p)
-                fluid.add_property(p)
-            t.append(sd['t']*diameter/umax)
-            sph_eval.update_particle_arrays([solid, fluid])
-            sph_eval.evaluate()
-            cd.append(np.sum(solid.au*solid.m)/(0.5*rho*umax**2*diameter))
-            cl.append(np.sum(solid.av*solid.m)/(0.5*rho*umax**2*diameter))
-        t, cd, cl = list(map(np.asarray, (t, cd, cl)))
+        sph_eval, solid, fluid = self._get_force_evaluator()
+
+        n_files = len(self.output_files)
+        t, cd, cl = np.empty(n_files), np.empty(n_files), np.empty(n_files)
+        inv_denom = 1.0/(0.5*rho*umax**2*diameter)
+        files = self.output_files
+        # Load the next frame in the background while the current one is
+        # evaluated, the reading is mostly done in C code without the GIL.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(load, files[0])
+            for i in range(n_files):
+                data = future.result()
+                if i + 1 < n_files:
+                    future = executor.submit(load, files[i + 1])
+                sd, arrays = data['solver_data'], data['arrays']
+                # The evaluator's solid array is reused. The positions are
+                # copied as well since reordering the particles permutes the
+                # solid between frames.
+                self._copy_frame(solid, arrays['solid'])
+                frame_fluid = arrays['fluid']
+                if (frame_fluid.get_number_of_particles() ==
+                        fluid.get_number_of_particles()):
+                    self._copy_frame(fluid, frame_fluid)
+                    sph_eval.update()
+                else:
+                    # The inlet/outlet changed the number of fluid particles.
+                    fluid = frame_fluid
+                    self._add_force_props(fluid)
+                    sph_eval.update_particle_arrays([solid, fluid])
+                t[i] = sd['t']*diameter/umax
+                sph_eval.evaluate()
+                cd[i] = np.dot(solid.au, solid.m) * inv_denom
+                cl[i] = np.dot(solid.av, solid.m) * inv_denom
         # Now plot the results.
         import matplotlib
         matplotlib.use('Agg')
@@ -345,6 +492,11 @@ class WindTunnel(Application):
 
 
 if __name__ == '__main__':
+    # The generated equations can be built with more aggressive flags by
+    # exporting, e.g., CFLAGS='-O3 -march=native -ffast-math' before running.
+    # The flags are not part of the hash of compyle's build cache, so clear it
+    # (~/.pysph/source by default) when changing them, otherwise the modules
+    # built with the old flags are silently reused.
     app = WindTunnel()
     app.run()
     app.post_process(app.info_filename)
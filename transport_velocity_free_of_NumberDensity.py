@@ -12,14 +12,50 @@ References
         smoothed particle hydrodynamics", Journal of Computational Physics
         (2013), pp. 292--307.
 
+Notes
+-----
+The equations here assume every particle property is its own contiguous
+1D ``float64`` array (a structure of arrays), so that each kernel only
+streams the few fields it reads.  Use :func:`ensure_soa_properties` when
+setting up the particle arrays to check this.
+
+The host arrays are always ``float64``.  All the scratch variables are
+declared as ``double`` so that, on the OpenCL and CUDA backends, the generated
+code as well as the device copies of these arrays drop to ``float32`` unless
+``--use-double`` is passed.  The Cython backend always runs in double
+precision.
+
 """
 
+import numpy as np
+
 from pysph.sph.equation import Equation
-from math import sin, pi
-from pysph.sph.wc.linalg import mat_vec_mult, mat_mult
+from math import sin, pi, sqrt
 # constants
 M_PI = pi
 
+
+def ensure_soa_properties(pa, props):
+    """Make sure `pa` stores each of `props` as a contiguous double array.
+
+    Missing properties are added as doubles, a ValueError is raised for
+    existing properties of any other layout.
+    """
+    bad = []
+    for prop in props:
+        if prop not in pa.properties:
+            pa.add_property(prop, type='double')
+            continue
+        arr = pa.get_carray(prop).get_npy_array()
+        if not arr.flags.c_contiguous or arr.dtype != np.float64:
+            bad.append(prop)
+    if bad:
+        raise ValueError(
+            "%s: %s must be contiguous float64 arrays" %
+            (pa.name, ', '.join(bad))
+        )
+
+
 class VolumeSummation(Equation):
     r"""**Number density for volume computation**
 
@@ -69,8 +105,23 @@ class SummationDensity(Equation):
     def initialize(self, d_idx, d_rho):
         d_rho[d_idx] = 0.0
 
-    def loop(self, d_idx, d_rho, s_m, WIJ, s_idx):
-        d_rho[d_idx] += s_m[s_idx]*WIJ
+    def loop_all(self, d_idx, d_x, d_y, d_z, d_h, d_rho, s_x, s_y, s_z, s_h,
+                 s_m, SPH_KERNEL, NBRS, N_NBRS):
+        i = declare('int')
+        s_idx = declare('long')
+        xij = declare('matrix(3)')
+        rij, hij, rho_s = declare('double', 3)
+        rho_s = 0.0
+        for i in range(N_NBRS):
+            s_idx = NBRS[i]
+            xij[0] = d_x[d_idx] - s_x[s_idx]
+            xij[1] = d_y[d_idx] - s_y[s_idx]
+            xij[2] = d_z[d_idx] - s_z[s_idx]
+            rij = sqrt(xij[0]*xij[0] + xij[1]*xij[1] + xij[2]*xij[2])
+            hij = 0.5*(d_h[d_idx] + s_h[s_idx])
+            rho_s += s_m[s_idx]*SPH_KERNEL.kernel(xij, rij, hij)
+
+        d_rho[d_idx] += rho_s
 
 
 
@@ -122,10 +173,12 @@ class SetWallVelocity(Equation):
         # calculation is done only for the relevant boundary particles.
         # d_wij (and d_uf) is 0 for particles sufficiently away from the
         # solid-fluid interface
+        wij1 = declare('double')
         if d_wij[d_idx] > 1e-12:
-            d_uf[d_idx] /= d_wij[d_idx]
-            d_vf[d_idx] /= d_wij[d_idx]
-            d_wf[d_idx] /= d_wij[d_idx]
+            wij1 = 1.0/d_wij[d_idx]
+            d_uf[d_idx] *= wij1
+            d_vf[d_idx] *= wij1
+            d_wf[d_idx] *= wij1
 
         # Dummy velocities at the ghost points using Eq. (23),
         # d_u, d_v, d_w are the prescribed wall velocities.
@@ -150,6 +203,7 @@ class ContinuityEquation(Equation):
         d_arho[d_idx] = 0.0
 
     def loop(self, d_idx, s_idx, d_arho, s_m, s_rho, d_rho, VIJ, DWIJ):
+        vijdotdwij = declare('double')
         vijdotdwij = VIJ[0] * DWIJ[0] + VIJ[1] * DWIJ[1] + VIJ[2] * DWIJ[2]
         d_arho[d_idx] += d_rho[d_idx] * vijdotdwij * s_m[s_idx] / s_rho[s_idx]
 
@@ -163,14 +217,14 @@ class ContinuitySolid(Equation):
     """
     def loop(self, d_idx, s_idx, d_rho, d_u, d_v, d_w, d_arho,
              s_m, s_rho, s_ug, s_vg, s_wg, DWIJ):
+        Vj, uij, vij, wij, vij_dot_dwij = declare('double', 5)
         Vj = s_m[s_idx] / s_rho[s_idx]
-        rhoi = d_rho[d_idx]
         uij = d_u[d_idx] - s_ug[s_idx]
         vij = d_v[d_idx] - s_vg[s_idx]
         wij = d_w[d_idx] - s_wg[s_idx]
         vij_dot_dwij = uij*DWIJ[0] + vij*DWIJ[1] + wij*DWIJ[2]
 
-        d_arho[d_idx] += rhoi*Vj*vij_dot_dwij
+        d_arho[d_idx] += d_rho[d_idx]*Vj*vij_dot_dwij
 
 
 class StateEquation(Equation):
@@ -210,10 +264,13 @@ class StateEquation(Equation):
         self.b = b
         self.p0 = p0
         self.rho0 = rho0
+        # p = p0/rho0 rho - p0 b, with both coefficients folded once.
+        self.p0_rho0 = p0/rho0
+        self.p0_b = p0*b
         super(StateEquation, self).__init__(dest, sources)
 
     def loop(self, d_idx, d_p, d_rho):
-        d_p[d_idx] = self.p0 * (d_rho[d_idx]/self.rho0 - self.b)
+        d_p[d_idx] = self.p0_rho0 * d_rho[d_idx] - self.p0_b
 
 
 class MomentumEquationPressureGradient(Equation):
@@ -281,6 +338,8 @@ class MomentumEquationPressureGradient(Equation):
     def loop(self, d_idx, s_idx, d_m, d_rho, s_rho,
              d_au, d_av, d_aw, d_p, s_p,
              d_auhat, d_avhat, d_awhat, d_V, s_V, DWIJ):
+        rhoi, rhoj, p_i, p_j, pij, tmp = declare('double', 6)
+        Vi, Vj, Vij2, mi1 = declare('double', 4)
 
         # averaged pressure Eq. (7)
         rhoi = d_rho[d_idx]
@@ -294,27 +353,27 @@ class MomentumEquationPressureGradient(Equation):
         # particle volumes; d_V is inverse volume
         Vi = 1./d_V[d_idx]
         Vj = 1./s_V[s_idx]
-        Vi2 = Vi * Vi
-        Vj2 = Vj * Vj
+        Vij2 = Vi * Vi + Vj * Vj
 
         # inverse mass of destination particle
         mi1 = 1.0/d_m[d_idx]
 
         # accelerations 1st term in Eq. (8)
-        tmp = -pij * mi1 * (Vi2 + Vj2)
+        tmp = -pij * mi1 * Vij2
 
         d_au[d_idx] += tmp * DWIJ[0]
         d_av[d_idx] += tmp * DWIJ[1]
         d_aw[d_idx] += tmp * DWIJ[2]
 
         # contribution due to the background pressure Eq. (13)
-        tmp = -self.pb * mi1 * (Vi2 + Vj2)
+        tmp = -self.pb * mi1 * Vij2
 
         d_auhat[d_idx] += tmp * DWIJ[0]
         d_avhat[d_idx] += tmp * DWIJ[1]
         d_awhat[d_idx] += tmp * DWIJ[2]
 
     def post_loop(self, d_idx, d_au, d_av, d_aw, t):
+        damping_factor = declare('double')
         # damped accelerations due to body or external force
         damping_factor = 1.0
         if t < self.tdamp:
@@ -345,15 +404,14 @@ class MomentumEquationViscosity(Equation):
 
     def loop(self, d_idx, s_idx, d_rho, s_rho, s_m, d_au,
              d_av, d_aw, VIJ, R2IJ, EPS, DWIJ, XIJ):
-        etai = self.nu * d_rho[d_idx]
-        etaj = self.nu * s_rho[s_idx]
-
-        etaij = 4 * (etai * etaj)/(etai + etaj)
-
+        xdotdij, fac = declare('double', 2)
         xdotdij = DWIJ[0]*XIJ[0] + DWIJ[1]*XIJ[1] + DWIJ[2]*XIJ[2]
 
-        tmp = s_m[s_idx]/(d_rho[d_idx] * s_rho[s_idx])
-        fac = tmp * etaij * xdotdij/(R2IJ + EPS)
+        # With eta = nu*rho, 4 eta_a eta_b/(eta_a + eta_b) times
+        # m_b/(rho_a rho_b) is 4 nu m_b/(rho_a + rho_b).
+        fac = 4.0 * self.nu * s_m[s_idx] * xdotdij/(
+            (d_rho[d_idx] + s_rho[s_idx]) * (R2IJ + EPS)
+        )
 
         d_au[d_idx] += fac * VIJ[0]
         d_av[d_idx] += fac * VIJ[1]
@@ -394,6 +452,8 @@ class MomentumEquationArtificialViscosity(Equation):
 
         self.alpha = alpha
         self.c0 = c0
+        # constant part of the pairwise viscosity, folded once here
+        self.alpha_c0 = alpha * c0
         super(MomentumEquationArtificialViscosity, self).__init__(
             dest, sources
         )
@@ -405,17 +465,17 @@ class MomentumEquationArtificialViscosity(Equation):
 
     def loop(self, d_idx, s_idx, s_m, d_au, d_av, d_aw,
              RHOIJ1, R2IJ, EPS, DWIJ, VIJ, XIJ, HIJ):
+        vijdotrij, muij, piij = declare('double', 3)
 
         # v_{ab} \cdot r_{ab}
         vijdotrij = VIJ[0]*XIJ[0] + VIJ[1]*XIJ[1] + VIJ[2]*XIJ[2]
 
-        # scalar part of the accelerations Eq. (11)
-        piij = 0.0
-        if vijdotrij < 0:
-            muij = (HIJ * vijdotrij)/(R2IJ + EPS)
+        # scalar part of the accelerations Eq. (11), only approaching
+        # particles contribute; min() keeps this free of a data dependent
+        # branch so the pair loop can be vectorized.
+        muij = (HIJ * min(vijdotrij, 0.0))/(R2IJ + EPS)
 
-            piij = -self.alpha*self.c0*muij
-            piij = s_m[s_idx] * piij*RHOIJ1
+        piij = -self.alpha_c0 * s_m[s_idx] * RHOIJ1 * muij
 
         d_au[d_idx] += -piij * DWIJ[0]
         d_av[d_idx] += -piij * DWIJ[1]
@@ -454,49 +514,26 @@ class MomentumEquationArtificialStress(Equation):
         d_av[d_idx] = 0.0
         d_aw[d_idx] = 0.0
 
-    def _get_helpers_(self):
-        return [mat_vec_mult]
-
     def loop(self, d_idx, s_idx, d_rho, s_rho, d_u, d_v, d_w, d_uhat, d_vhat,
              d_what, s_u, s_v, s_w, s_uhat, s_vhat, s_what, d_au, d_av, d_aw,
              s_m, DWIJ):
-        rhoi = d_rho[d_idx]
-        rhoj = s_rho[s_idx]
-
-        i, j = declare('int', 2)
-        ui, uj, uidif, ujdif, res = declare('matrix(3)', 5)
-        Aij = declare('matrix(9)')
-
-        for i in range(3):
-            res[i] = 0.0
-            for j in range(3):
-                Aij[3*i + j] = 0.0
-
-        ui[0] = d_u[d_idx]
-        ui[1] = d_v[d_idx]
-        ui[2] = d_w[d_idx]
+        rhoi1, rhoj1, adwi, adwj = declare('double', 4)
+        rhoi1 = 1.0/d_rho[d_idx]
+        rhoj1 = 1.0/s_rho[s_idx]
 
-        uj[0] = s_u[s_idx]
-        uj[1] = s_v[s_idx]
-        uj[2] = s_w[s_idx]
+        # A_ij = u_a[i] (uhat_a - u_a)[j]/rho_a + u_b[i] (uhat_b - u_b)[j]/rho_b
+        # so A . DWIJ only needs the projection of (uhat - u) on DWIJ for
+        # each of the two particles.
+        adwi = ((d_uhat[d_idx] - d_u[d_idx])*DWIJ[0] +
+                (d_vhat[d_idx] - d_v[d_idx])*DWIJ[1] +
+                (d_what[d_idx] - d_w[d_idx])*DWIJ[2]) * rhoi1
+        adwj = ((s_uhat[s_idx] - s_u[s_idx])*DWIJ[0] +
+                (s_vhat[s_idx] - s_v[s_idx])*DWIJ[1] +
+                (s_what[s_idx] - s_w[s_idx])*DWIJ[2]) * rhoj1
 
-        uidif[0] = d_uhat[d_idx] - d_u[d_idx]
-        uidif[1] = d_vhat[d_idx] - d_v[d_idx]
-        uidif[2] = d_what[d_idx] - d_w[d_idx]
-
-        ujdif[0] = s_uhat[s_idx] - s_u[s_idx]
-        ujdif[1] = s_vhat[s_idx] - s_v[s_idx]
-        ujdif[2] = s_what[s_idx] - s_w[s_idx]
- 
-        for i in range(3):
-            for j in range(3):
-                Aij[3*i + j] = (ui[i]*uidif[j] / rhoi + uj[i]*ujdif[j] / rhoj)
-
-        mat_vec_mult(Aij, DWIJ, 3, res)
-
-        d_au[d_idx] += s_m[s_idx] * res[0]
-        d_av[d_idx] += s_m[s_idx] * res[1]
-        d_aw[d_idx] += s_m[s_idx] * res[2]
+        d_au[d_idx] += s_m[s_idx] * (d_u[d_idx]*adwi + s_u[s_idx]*adwj)
+        d_av[d_idx] += s_m[s_idx] * (d_v[d_idx]*adwi + s_v[s_idx]*adwj)
+        d_aw[d_idx] += s_m[s_idx] * (d_w[d_idx]*adwi + s_w[s_idx]*adwj)
 
 
 
@@ -557,15 +594,14 @@ class SolidWallNoSlipBC(Equation):
 
 
     def loop(self, d_idx, s_idx, d_rho, s_rho, s_m, d_au, d_u, d_v, d_w, d_av, d_aw, VIJ, R2IJ, EPS, DWIJ, XIJ, s_ug, s_vg, s_wg):
-        etai = self.nu * d_rho[d_idx]
-        etaj = self.nu * s_rho[s_idx]
-
-        etaij = 4 * (etai * etaj)/(etai + etaj)
-
+        xdotdij, fac = declare('double', 2)
         xdotdij = DWIJ[0]*XIJ[0] + DWIJ[1]*XIJ[1] + DWIJ[2]*XIJ[2]
 
-        tmp = s_m[s_idx]/(d_rho[d_idx] * s_rho[s_idx])
-        fac = tmp * etaij * xdotdij/(R2IJ + EPS)
+        # With eta = nu*rho, 4 eta_a eta_b/(eta_a + eta_b) times
+        # m_b/(rho_a rho_b) is 4 nu m_b/(rho_a + rho_b).
+        fac = 4.0 * self.nu * s_m[s_idx] * xdotdij/(
+            (d_rho[d_idx] + s_rho[s_idx]) * (R2IJ + EPS)
+        )
 
         d_au[d_idx] += fac * (d_u[d_idx] - s_ug[s_idx])
         d_av[d_idx] += fac * (d_v[d_idx] - s_vg[s_idx])
@@ -638,6 +674,9 @@ class SolidWallPressureBC(Equation):
         self.gx = gx
         self.gy = gy
         self.gz = gz
+        # rho = rho0/p0 p + rho0 b, with both coefficients folded once.
+        self.rho0_p0 = rho0/p0
+        self.rho0_b = rho0*b
 
         super(SolidWallPressureBC, self).__init__(dest, sources)
 
@@ -647,6 +686,7 @@ class SolidWallPressureBC(Equation):
 
     def loop(self, d_idx, s_idx, d_p, s_p, d_wij, s_rho,
              d_au, d_av, d_aw, WIJ, XIJ):
+        gdotxij = declare('double')
 
         # numerator of Eq. (27) ax, ay and az are the prescribed wall
         # accelerations which must be defined for the wall boundary
@@ -655,7 +695,7 @@ class SolidWallPressureBC(Equation):
             (self.gy - d_av[d_idx])*XIJ[1] + \
             (self.gz - d_aw[d_idx])*XIJ[2]
 
-        d_p[d_idx] += s_p[s_idx]*WIJ + s_rho[s_idx]*gdotxij*WIJ
+        d_p[d_idx] += (s_p[s_idx] + s_rho[s_idx]*gdotxij)*WIJ
 
         # denominator of Eq. (27)
         d_wij[d_idx] += WIJ
@@ -666,4 +706,4 @@ class SolidWallPressureBC(Equation):
             d_p[d_idx] /= d_wij[d_idx]
 
         # update the density from the pressure Eq. (28)
-        d_rho[d_idx] = self.rho0 * (d_p[d_idx]/self.p0 + self.b)
+        d_rho[d_idx] = self.rho0_p0 * d_p[d_idx] + self.rho0_b